@@ -11,15 +11,16 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gdk, GLib, GObject, Gtk
 
 import argparse
-import collections
 import os
 import pathlib
 import time
 import datetime
-import statistics
+import functools
+import math
+import sys
+import zoneinfo
 from socket import error as SocketError
 
-import dateutil.parser
 import gps
 import gps.clienthelpers
 import astral
@@ -31,6 +32,13 @@ import astral.sun
 FONTS = ('Roboto Slab', 'Inter', 'Roboto', 'Source Sans Pro',
          'Piboto', 'Open Sans', 'DejaVu Sans')
 
+# Indexed by TPV status and mode respectively.
+FIX_STATUS = ('Unknown', 'Normal', 'DGPS', 'RTK Fixed', 'RTK Floating', 'DR',
+              'GNSS+DR', 'Time (surveyed)', 'Simulated', 'P(Y)')
+FIX_MODE = ('Unknown fix', 'No fix', ' 2D fix', ' 3D fix')
+
+COMPASS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW', 'N')
+
 GNSS_MAP = {
     0: 'GPS',
     1: 'SBAS',
@@ -39,15 +47,17 @@ GNSS_MAP = {
     4: 'IMES',
     5: 'QZSS',
     6: 'GLONASS',
+    7: 'NavIC',
 }
 
 GNSS_FLAG_ISO = {
     0: 'US',
     2: 'EU',
     3: 'CN',
-    4: 'IN',
+    4: 'JP',  # IMES
     5: 'JP',
     6: 'RU',
+    7: 'IN',
 }
 
 GNSS_FLAG = {k: ''.join(chr(0x1f1e6+ord(x)-ord('A')) for x in v)
@@ -55,15 +65,99 @@ GNSS_FLAG = {k: ''.join(chr(0x1f1e6+ord(x)-ord('A')) for x in v)
 
 GNSS_FLAG[1] = '\N{SATELLITE}'  # SBAS
 
+# Indexed by gnssid for the per-redraw satellite summary.
+GNSS_FLAG_TUP = tuple(GNSS_FLAG[i] for i in range(len(GNSS_MAP)))
+
+
+# Indexed by whether the coordinate is negative.
+LATITUDE_FORMATS = ('{:.5f}°\u200aN'.format, '{:.5f}°\u200aS'.format)
+LONGITUDE_FORMATS = ('{:.5f}°\u200aE'.format, '{:.5f}°\u200aW'.format)
+
 
 def format_latitude(latitude: float) -> str:
-    hemisphere = 'N' if latitude >= 0 else 'S'
-    return f'{abs(latitude):.5f}°\u200a{hemisphere}'
+    return LATITUDE_FORMATS[latitude < 0](abs(latitude))
 
 
 def format_longitude(longitude: float) -> str:
-    hemisphere = 'E' if longitude >= 0 else 'W'
-    return f'{abs(longitude):.5f}°\u200a{hemisphere}'
+    return LONGITUDE_FORMATS[longitude < 0](abs(longitude))
+
+
+# GPSD sends RFC 3339 UTC times; fromisoformat() only accepts a trailing
+# 'Z' from Python 3.11 on.
+if sys.version_info >= (3, 11):
+    parse_time = datetime.datetime.fromisoformat
+else:
+    def parse_time(timestamp: str) -> datetime.datetime:
+        if timestamp.endswith('Z'):
+            timestamp = timestamp[:-1] + '+00:00'
+        return datetime.datetime.fromisoformat(timestamp)
+
+
+def summarize(values):
+    # One pass for count, extremes, mean and sample standard deviation.
+    n = 0
+    total = 0.0
+    total_sq = 0.0
+    lo = math.inf
+    hi = -math.inf
+    for v in values:
+        n += 1
+        total += v
+        total_sq += v*v
+        if v < lo:
+            lo = v
+        if v > hi:
+            hi = v
+    mean = total / n
+    var = (total_sq - total*total/n) / (n-1) if n > 1 else 0.0
+    return n, lo, hi, mean, math.sqrt(max(var, 0.0))
+
+
+def local_timezone():
+    # Resolve the display zone once; ZoneInfo conversions run in C.
+    # None makes astimezone()/now() fall back to the C library's zone.
+    tz = os.environ.get('TZ')
+    if tz is not None:
+        # An empty TZ means UTC to libc, and POSIX rule strings like
+        # 'JST-9' aren't zoneinfo keys; leave those to libc rather than
+        # guessing from /etc/localtime.
+        key = tz.lstrip(':')
+        if not key:
+            return None
+        try:
+            if key.startswith('/'):
+                with open(key, 'rb') as tzfile:
+                    return zoneinfo.ZoneInfo.from_file(tzfile, key=key)
+            return zoneinfo.ZoneInfo(key)
+        except (OSError, ValueError, zoneinfo.ZoneInfoNotFoundError):
+            return None
+    try:
+        with open('/etc/localtime', 'rb') as tzfile:
+            return zoneinfo.ZoneInfo.from_file(tzfile, key='localtime')
+    except (OSError, ValueError):
+        return None
+
+
+LOCAL_TZ = local_timezone()
+
+
+@functools.lru_cache(maxsize=32)
+def solar_timezone(hours: int) -> datetime.timezone:
+    return datetime.timezone(datetime.timedelta(hours=hours))
+
+
+@functools.lru_cache(maxsize=32)
+def daylight(date, latitude, longitude, solar_tz):
+    # Returns (sunrise, sunset), or a bool during polar day/night.
+    # Sun times barely move within 0.1° of position, so callers round
+    # the coordinates to make this cache effective.
+    loc = astral.Observer(latitude=latitude, longitude=longitude)
+    try:
+        return astral.sun.daylight(loc, date, solar_tz)
+    except ValueError:
+        noon = astral.sun.noon(loc, date=date)
+        # Sun is not up at noon, so it's winter
+        return astral.sun.elevation(loc, noon) >= 0
 
 
 class Handler:
@@ -111,10 +205,16 @@ class HeadUpDisplay(Gtk.Window):
         self.altitude = None
         self.skyview = None
         self.last_tpv = None
+        self.last_time = None
+        self._pending = False
+        self._last_markup = {}
+        self._last_minute = None
+        self._last_position = None
+        self._position_text = ''
 
         self.font_face = ''
         context = self.create_pango_context()
-        families = (fam.get_name() for fam in context.list_families())
+        families = frozenset(fam.get_name() for fam in context.list_families())
         for font in FONTS:
             if font in families:
                 self.font_face = font
@@ -131,6 +231,8 @@ class HeadUpDisplay(Gtk.Window):
         self.position_markup = f"<span font='17.5' face='{self.font_face}' color='%s' font_features='tnum=1,lnum=1'>%s</span>"
         self.thick_blank_markup = "<span font='12' color='#000000'> </span>"
         self.thin_blank_markup = "<span font='2' color='#000000'> </span>"
+        self.markups_day = self.bake_markups('#FFFFFF', '#888888')
+        self.markups_night = self.bake_markups('#BBBBBB', '#666666')
 
         self.builder = Gtk.Builder()
         filename = str(pathlib.Path(__file__).parent / "gpshud.glade")
@@ -146,154 +248,167 @@ class HeadUpDisplay(Gtk.Window):
         # self.builder.get_object("Blank4").set_markup(self.thick_blank_markup)
         # self.builder.get_object("Blank5").set_markup(self.thick_blank_markup)
         # self.builder.get_object("BottomBlank").set_markup(self.thin_blank_markup)
+
+        self._w_heading = self.builder.get_object("Heading")
+        self._w_speed = self.builder.get_object("Speed")
+        self._w_unit = self.builder.get_object("Unit")
+        self._w_date = self.builder.get_object("Date")
+        self._w_time = self.builder.get_object("Time")
+        self._w_fix = self.builder.get_object("Fix")
+        self._w_position = self.builder.get_object("Position")
+        # The time shares the Date label; keep show_all() from revealing it.
+        self._w_time.set_no_show_all(True)
+        self._w_time.set_visible(False)
         self.update_data()
 
+    def bake_markups(self, color, unitcolor):
+        # Substitute the colors up front, leaving a single text slot, and
+        # keep the bound str.format of each so a redraw is one C call.
+        return {
+            'heading': (self.heading_markup % (color, '{}')).format,
+            'speed': (self.speed_markup % (color, '{}')).format,
+            'unit': (self.unit_markup % (unitcolor, '{}')).format,
+            'today': (self.today_markup % (color, '{}')).format,
+            'now': (self.now_markup % (color, '{}')).format,
+            'fix': (self.fix_markup % (color, '{}')).format,
+            'position': (self.position_markup % (color, '{}')).format,
+        }
+
     def update_data(self):
-        if self.is_day():
-            color = '#FFFFFF'
-            unitcolor = '#888888'
+        # TPV and SKY reports arrive back to back; redraw once for both.
+        if not self._pending:
+            self._pending = True
+            GLib.idle_add(self._flush)
+        return True
+
+    def _set_markup(self, widget, markup):
+        # Pango reparses and relayouts on every set_markup, even when the
+        # text is identical, so only push actual changes.
+        if self._last_markup.get(widget) != markup:
+            widget.set_markup(markup)
+            self._last_markup[widget] = markup
+
+    def _flush(self):
+        self._pending = False
+        self._do_update()
+        return False
+
+    def _do_update(self):
+        day = self.is_day()
+        m = self.markups_day if day else self.markups_night
+
+        if self.last_mode < 2:
+            heading_text = speed_text = '-'
         else:
-            color = '#BBBBBB'
-            unitcolor = '#666666'
-
-        # if self.last_mode in (0, 1):
-        #     color = '#000000'
-        #     unitcolor = '#000000'
-
-        self.builder.get_object("Heading").set_markup(self.heading_markup % (
-                color, self.get_direction_text(self.last_heading)))
-        self.builder.get_object("Speed").set_markup(self.speed_markup % (
-                color, self.get_speed_text(self.last_speed)))
-        self.builder.get_object("Unit").set_markup(self.unit_markup % (
-                unitcolor, self.speed_unit.upper()))
-
-        if self.last_mode >= 2 and self.last_tpv.time:
-            now = dateutil.parser.isoparse(self.last_tpv.time).astimezone()
+            heading_text = COMPASS[int((self.last_heading+22.5) * (1/45))]
+            speed_text = format(self.last_speed*self.speedfactor, '.0f')
+        self._set_markup(self._w_heading, m['heading'](heading_text))
+        self._set_markup(self._w_speed, m['speed'](speed_text))
+        self._set_markup(self._w_unit, m['unit'](self.speed_unit.upper()))
+
+        if self.last_mode >= 2 and self.last_time:
+            now = self.last_time
             # print(now)
         else:
-            now = datetime.datetime.now()
-
-        dtstr = (self.today_markup % (color, now.strftime(self.date_fmt)) +
-                 '\n' + self.now_markup % (color, now.strftime(self.now_fmt)))
-
-        self.builder.get_object("Date").set_markup(dtstr)
-        self.builder.get_object("Time").set_visible(False)
+            now = datetime.datetime.now(LOCAL_TZ)
+
+        # _set_markup already drops repeats; this only skips the strftime
+        # calls, since neither format changes more than once a minute
+        # (or when the colors switch between day and night).
+        minute = (now.year, now.month, now.day, now.hour, now.minute, day)
+        if minute != self._last_minute:
+            self._last_minute = minute
+            dtstr = (m['today'](now.strftime(self.date_fmt)) +
+                     '\n' + m['now'](now.strftime(self.now_fmt)))
+            self._set_markup(self._w_date, dtstr)
         # self.builder.get_object("Date").set_markup(self.today_markup % (
         #         color, now.strftime(self.date_fmt)))
         # self.builder.get_object("Time").set_markup(self.now_markup % (
         #         color, now.strftime(self.now_fmt)))
 
-        if self.last_status:
-            fixtext = ('Unknown', 'Normal', 'DGPS', 'RTK Fixed',
-                       'RTK Floating', 'DR', 'GNSS+DR', 'Time (surveyed)',
-                       'Simulated', 'P(Y)')[self.last_status]
-        else:
-            fixtext = ''
-
+        fix_parts = []
         if self.last_mode in (2, 3):
-            fixtext += f' {self.last_mode}D fix'
+            if self.last_status:
+                fix_parts.append(FIX_STATUS[self.last_status])
+            fix_parts.append(FIX_MODE[self.last_mode])
         elif self.last_mode == 1:
-            fixtext = 'No fix'
+            fix_parts.append(FIX_MODE[1])
         else:
-            fixtext = 'Unknown fix'
+            fix_parts.append(FIX_MODE[0])
 
         if self.skyview and 'uSat' in self.skyview and 'nSat' in self.skyview:
-            fixtext += f', {self.skyview.uSat}/{self.skyview.nSat} SVs'
-            # gnss_info = collections.defaultdict(list)
-            ucount = collections.defaultdict(int)
-            ncount = collections.defaultdict(int)
-            sigstrength = collections.defaultdict(float)
-            usedsigstrength = collections.defaultdict(float)
+            fix_parts.append(f', {self.skyview.uSat}/{self.skyview.nSat} SVs')
+            ucount = [0] * len(GNSS_FLAG_TUP)
+            all_ss = []
+            used_ss = []
             for sat in self.skyview.satellites:
-                if 'gnssid' in sat:
-                    # gnss_info[sat.gnssid].append(sat)
-                    ucount[sat.gnssid] += int(sat.used)
-                    ncount[sat.gnssid] += 1
-                    if 'ss' in sat:
-                        sigstrength[sat.PRN] = sat.ss
-                        if sat.used:
-                            usedsigstrength[sat.PRN] = sat.ss
-
-            # svlist = (f'{GNSS_MAP[gnss][:2]}: {ucount[gnss]}/{ncount[gnss]}' for gnss in ncount if ucount[gnss])
-            # svlist = (f'{GNSS_MAP[gnss][:2]}' for gnss in ncount if ucount[gnss])
-            svlist = tuple(f'{ucount[gnss]} {GNSS_FLAG[gnss]}'
-                           for gnss in ucount if ucount[gnss] > 0)
+                gid = getattr(sat, 'gnssid', -1)
+                if not 0 <= gid < len(ucount):
+                    continue
+                used = sat.used
+                ucount[gid] += used
+                if 'ss' in sat:
+                    ss = sat.ss
+                    all_ss.append(ss)
+                    if used:
+                        used_ss.append(ss)
+
+            svlist = [f'{count} {flag}'
+                      for count, flag in zip(ucount, GNSS_FLAG_TUP) if count > 0]
             if svlist:
-                fixtext += '\n<span font="12">'+' '.join(svlist)+'</span>'
-            if sigstrength:
-                strengths = tuple(sigstrength.values())
-                min_ss, max_ss = min(strengths), max(strengths)
-                fixtext += f'\n<span font="10">All SNR: {min_ss:.0f}–{max_ss:.0f}'
-                if len(strengths) > 1:
-                    mean_ss = statistics.fmean(strengths)
-                    sd_ss = statistics.stdev(strengths)
-                    fixtext += f', \U0001D465\u0305={mean_ss:.1f}, \U0001D460={sd_ss:.1f}'
-                fixtext += '</span>'
-            if usedsigstrength:
-                strengths = tuple(usedsigstrength.values())
-                min_ss, max_ss = min(strengths), max(strengths)
-                fixtext += f'\n<span font="10">Used SNR: {min_ss:.0f}–{max_ss:.0f}'
-                if len(strengths) > 1:
-                    mean_ss = statistics.fmean(strengths)
-                    sd_ss = statistics.stdev(strengths)
-                    fixtext += f', \U0001D465\u0305={mean_ss:.1f}, \U0001D460={sd_ss:.1f}'
-                fixtext += '</span>'
-
-        postext = ''
+                fix_parts.append('\n<span font="12">')
+                fix_parts.append(' '.join(svlist))
+                fix_parts.append('</span>')
+            for label, strengths in (('\n<span font="10">All SNR: ', all_ss),
+                                     ('\n<span font="10">Used SNR: ', used_ss)):
+                if not strengths:
+                    continue
+                n_ss, min_ss, max_ss, mean_ss, sd_ss = summarize(strengths)
+                fix_parts.append(label)
+                fix_parts.append(f'{min_ss:.0f}–{max_ss:.0f}')
+                if n_ss > 1:
+                    fix_parts.append(f', \U0001D465\u0305={mean_ss:.1f}, \U0001D460={sd_ss:.1f}')
+                fix_parts.append('</span>')
+
+        pos_parts = []
         if self.latitude is not None and self.longitude is not None:
-            postext = (format_latitude(self.latitude) + '\n' +
-                       format_longitude(self.longitude))
+            # A stationary vehicle keeps reporting the same position.
+            position = (self.latitude, self.longitude)
+            if position != self._last_position:
+                self._last_position = position
+                self._position_text = (format_latitude(self.latitude) + '\n' +
+                                       format_longitude(self.longitude))
+            pos_parts.append(self._position_text)
             if self.last_tpv and 'eph' in self.last_tpv:
                 eph = self.last_tpv.eph*self.altfactor
-                fixtext += f'\nCEP: ±\u200a{eph:.1f} {self.altitude_unit}'
+                fix_parts.append(f'\nCEP: ±\u200a{eph:.1f} {self.altitude_unit}')
 
             if self.altitude:
                 alt = self.altitude * self.altfactor
                 if self.last_tpv and 'epv' in self.last_tpv:
                     epv = self.last_tpv.epv*self.altfactor
-                    postext += f'\n{alt:#.5n}\u200a±\u200a{epv:.1f} {self.altitude_unit}'
+                    pos_parts.append(f'\n{alt:#.5n}\u200a±\u200a{epv:.1f} {self.altitude_unit}')
                 else:
-                    postext += f'\n{alt:#.5n} {self.altitude_unit}'
+                    pos_parts.append(f'\n{alt:#.5n} {self.altitude_unit}')
 
-        self.builder.get_object("Fix").set_markup(self.fix_markup % (
-                color, fixtext))
+        fixtext = ''.join(fix_parts)
+        postext = ''.join(pos_parts)
+        self._set_markup(self._w_fix, m['fix'](fixtext))
 
-        self.builder.get_object('Position').set_markup(self.position_markup % (color, postext))
-        return True
-
-    def get_speed_text(self, speed):
-        if self.last_mode in (0, 1):
-            return "-"
-        else:
-            return '%.0f' % (speed * self.speedfactor)
-
-    def get_direction_text(self, heading):
-        if self.last_mode in (0, 1):
-            direction = '-'
-        else:
-            direction = ('N', 'NE', 'E', 'SE',
-                         'S', 'SW', 'W', 'NW', 'N')[int((heading+22.5)//45)]
-        return direction
+        self._set_markup(self._w_position, m['position'](postext))
 
     def is_day(self):
         if self.longitude is None or self.latitude is None:
             return True
 
-        solar_tz = datetime.timezone(datetime.timedelta(
-            hours=(self.longitude+7.5) // 15))
-        loc = astral.Observer(latitude=self.latitude, longitude=self.longitude)
+        solar_tz = solar_timezone(int((self.longitude+7.5) // 15))
         now = datetime.datetime.now(solar_tz)
-        date = now.date()
-        try:
-            sunrise, sunset = astral.sun.daylight(loc, date, solar_tz)
-            return sunrise <= now <= sunset
-        except ValueError:
-            noon = astral.sun.noon(loc, date=date)
-            if astral.sun.elevation(noon) < 0:
-                # Sun is not up at noon, so it's winter
-                return False
-            return True
-        return False
+        window = daylight(now.date(), round(self.latitude, 1),
+                          round(self.longitude, 1), solar_tz)
+        if isinstance(window, bool):
+            return window
+        sunrise, sunset = window
+        return sunrise <= now <= sunset
     
         # l = Location()
         # l.latitude = self.latitude
@@ -344,12 +459,15 @@ class Main(object):
 
         if self.daemon.read() == -1:
             self.handle_hangup(source, condition)
+            return True
+        data = self.daemon.data
         if self.debug:
-            print('Response:', self.daemon.data, file=sys.stderr)
-        if self.daemon.data['class'] == 'TPV':
-            self.update_speed(self.daemon.data)
-        elif self.daemon.data['class'] == 'SKY':
-            self.update_sky(self.daemon.data)
+            print('Response:', data, file=sys.stderr)
+        cls = data['class']
+        if cls == 'TPV':
+            self.update_speed(data)
+        elif cls == 'SKY':
+            self.update_sky(data)
         return True
 
     def handle_hangup(self, _dummy, _unused):
@@ -374,6 +492,10 @@ class Main(object):
     def update_speed(self, data):
         self.widget.last_tpv = data
         self.widget.last_mode = data.mode
+        if 'time' in data and data.time:
+            self.widget.last_time = parse_time(data.time).astimezone(LOCAL_TZ)
+        else:
+            self.widget.last_time = None
         # if data.mode in (0, 1):
         #     self.renew_GPS()
 